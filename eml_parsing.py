@@ -0,0 +1,103 @@
+"""EML parsing, kept in its own module so the parse process pool can pickle it by name."""
+from email import policy
+from email.parser import BytesParser
+from datetime import datetime
+from email.utils import parsedate_tz, mktime_tz
+
+def parse_and_format_date(date_string):
+    """Parse email date and format it as DD/MM/YYYY HH:MM:SS"""
+    try:
+        # Parse the email date
+        parsed_date = parsedate_tz(date_string)
+        if parsed_date:
+            # Convert to timestamp and then to datetime
+            timestamp = mktime_tz(parsed_date)
+            dt = datetime.fromtimestamp(timestamp)
+            # Format as DD/MM/YYYY HH:MM:SS
+            return dt.strftime('%d/%m/%Y %H:%M:%S'), dt
+        else:
+            return date_string, None
+    except:
+        return date_string, None
+
+def decode_text_part(part):
+    """Decode a text body part directly, skipping the content manager dispatch."""
+    if part is None:
+        return ""
+    
+    raw = part.get_payload(decode=True) or b""
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return raw.decode(charset, errors='replace')
+    except LookupError:
+        # Unknown charset label, fall back rather than failing the whole email
+        return raw.decode('utf-8', errors='replace')
+
+def parse_s3_eml(file_content, filename):
+    """Parse an EML file from S3 and extract its content."""
+    try:
+        msg = BytesParser(policy=policy.default).parsebytes(file_content)
+        
+        # Extract basic information
+        # Plain str copies of the headers so results pickle cheaply across processes
+        subject = str(msg.get('Subject', 'No Subject'))
+        sender = str(msg.get('From', 'Unknown Sender'))
+        recipient = str(msg.get('To', 'Unknown Recipient'))
+        date_raw = str(msg.get('Date', 'Unknown Date'))
+        
+        # Parse and format the date
+        date_formatted, date_obj = parse_and_format_date(date_raw)
+        
+        # Extract body content
+        body_text_part = msg.get_body(preferencelist=('plain',))
+        body_html_part = msg.get_body(preferencelist=('html',))
+        body_text = decode_text_part(body_text_part)
+        body_html = decode_text_part(body_html_part)
+        
+        # Attachment metadata only, payloads stay encoded
+        attachments = []
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            content_disposition = str(part.get('Content-Disposition', ''))
+            
+            # Inline text and HTML parts are bodies, not attachments
+            if content_type in ('text/plain', 'text/html') and 'attachment' not in content_disposition:
+                continue
+            
+            attach_filename = part.get_filename()
+            if attach_filename:
+                try:
+                    # Keep base64 payloads encoded - they are only needed
+                    # again as base64 for the download link
+                    cte = part.get('Content-Transfer-Encoding', '').strip().lower()
+                    if part.is_multipart():
+                        # Attached message/rfc822: download the embedded message.
+                        # Checked first, its payload is a list even if marked base64
+                        payload_raw = part.get_payload(0).as_bytes()
+                    elif cte == 'base64':
+                        payload_raw = part.get_payload(decode=False)
+                    else:
+                        payload_raw = part.get_payload(decode=True)
+                    attachments.append({
+                        'filename': attach_filename,
+                        'payload_raw': payload_raw,
+                        'cte': cte,
+                        'content_type': content_type
+                    })
+                except Exception as e:
+                    # Use a placeholder for failed attachments instead of showing error
+                    pass
+        
+        return {
+            'subject': subject,
+            'sender': sender,
+            'recipient': recipient,
+            'date': date_formatted,
+            'date_obj': date_obj,  # Keep datetime object for sorting
+            'body_text': body_text,
+            'body_html': body_html,
+            'attachments': attachments
+        }
+    
+    except Exception as e:
+        return None
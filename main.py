@@ -1,20 +1,18 @@
 import streamlit as st
 import os
-import email
-from email import policy
-from email.parser import BytesParser
 import base64
-from datetime import datetime
 import re
 import html
-import pandas as pd
-from email.utils import parsedate_tz, mktime_tz
-import boto3
-from botocore.exceptions import NoCredentialsError, ClientError
-import concurrent.futures
+from urllib.parse import quote
+import io
+import functools
+import tarfile
 import threading
-from concurrent.futures import ThreadPoolExecutor
-import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import queue
+from eml_parsing import parse_s3_eml
 
 # Load environment variables for local development
 try:
@@ -75,220 +73,484 @@ def logout():
     st.session_state['authenticated'] = False
     st.rerun()
 
-def parse_and_format_date(date_string):
-    """Parse email date and format it as DD/MM/YYYY HH:MM:SS"""
-    try:
-        # Parse the email date
-        parsed_date = parsedate_tz(date_string)
-        if parsed_date:
-            # Convert to timestamp and then to datetime
-            timestamp = mktime_tz(parsed_date)
-            dt = datetime.fromtimestamp(timestamp)
-            # Format as DD/MM/YYYY HH:MM:SS
-            return dt.strftime('%d/%m/%Y %H:%M:%S'), dt
-        else:
-            return date_string, None
-    except:
-        return date_string, None
+@st.cache_resource(show_spinner=False)
+def _create_s3_client(max_pool_connections):
+    """Build a single shared S3 client, reused across reruns and threads"""
+    import boto3
+    from botocore.config import Config
+    
+    client_config = Config(
+        max_pool_connections=max_pool_connections,
+        retries={'mode': 'adaptive', 'max_attempts': 10},
+        tcp_keepalive=True
+    )
+    
+    # Try Streamlit secrets first (for cloud deployment)
+    if hasattr(st, 'secrets') and 'AWS_ACCESS_KEY_ID' in st.secrets:
+        return boto3.client(
+            's3',
+            aws_access_key_id=st.secrets["AWS_ACCESS_KEY_ID"],
+            aws_secret_access_key=st.secrets["AWS_SECRET_ACCESS_KEY"],
+            region_name=st.secrets.get("AWS_REGION", "us-east-1"),
+            config=client_config
+        )
+    # Fall back to environment variables (for local development)
+    else:
+        return boto3.client(
+            's3',
+            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+            region_name=os.getenv("AWS_REGION", "us-east-1"),
+            config=client_config
+        )
 
-def get_s3_client():
-    """Initialize S3 client using Streamlit secrets or environment variables"""
+def get_s3_client(max_workers=5):
+    """Get the cached S3 client using Streamlit secrets or environment variables"""
     try:
-        # Try Streamlit secrets first (for cloud deployment)
-        if hasattr(st, 'secrets') and 'AWS_ACCESS_KEY_ID' in st.secrets:
-            return boto3.client(
-                's3',
-                aws_access_key_id=st.secrets["AWS_ACCESS_KEY_ID"],
-                aws_secret_access_key=st.secrets["AWS_SECRET_ACCESS_KEY"],
-                region_name=st.secrets.get("AWS_REGION", "us-east-1")
-            )
-        # Fall back to environment variables (for local development)
-        else:
-            return boto3.client(
-                's3',
-                aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-                region_name=os.getenv("AWS_REGION", "us-east-1")
-            )
+        # Size the connection pool so every worker thread gets its own connection
+        return _create_s3_client(max_workers * 2)
     except Exception as e:
         st.error(f"Error connecting to S3: {str(e)}")
         return None
 
-def list_eml_files_from_s3(bucket_name, folder_prefix=""):
-    """List all EML files from S3 bucket"""
-    s3_client = get_s3_client()
-    if not s3_client:
-        return []
+@st.cache_resource(show_spinner=False)
+def _create_crt_transfer_manager(_s3_client, max_concurrency):
+    """Build a CRT-backed transfer manager, or None if the CRT can't be used"""
+    from boto3.s3.transfer import TransferConfig, create_transfer_manager
+    from botocore.compat import HAS_CRT
+    from s3transfer.manager import TransferManager as ClassicTransferManager
+    
+    if not HAS_CRT:
+        return None
+    
+    transfer_config = TransferConfig(
+        preferred_transfer_client='crt',
+        max_concurrency=max_concurrency
+    )
+    manager = create_transfer_manager(_s3_client, transfer_config)
+    
+    # boto3 silently falls back to the classic manager, which issues a HEAD
+    # before every GET - plain get_object is cheaper for small EML files
+    if isinstance(manager, ClassicTransferManager):
+        manager.shutdown()
+        return None
+    return manager
+
+def get_transfer_manager(s3_client, max_workers=5):
+    """Get the cached CRT transfer manager (requires awscrt), or None"""
+    try:
+        return _create_crt_transfer_manager(s3_client, max_workers * 2)
+    except Exception:
+        # CRT is an optional accelerator, fall back to get_object
+        return None
+
+# Archives of many EML files, fetched with one GET instead of one per email
+EML_BUNDLE_SUFFIXES = ('.tar', '.tar.gz', '.tgz')
+
+def is_eml_bundle(file_key):
+    """Check whether an S3 key is a tar bundle of EML files"""
+    return file_key.lower().endswith(EML_BUNDLE_SUFFIXES)
+
+def list_eml_files_from_s3(s3_client, bucket_name, folder_prefix="", exclude_prefix=""):
+    """List all EML files and EML bundles from S3 bucket as (key, ETag, size) tuples"""
+    from botocore.exceptions import ClientError
     
     try:
-        response = s3_client.list_objects_v2(
+        # Paginate so buckets with more than 1000 objects are fully listed
+        paginator = s3_client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(
             Bucket=bucket_name,
-            Prefix=folder_prefix
+            Prefix=folder_prefix,
+            PaginationConfig={'PageSize': 1000}
         )
         
         eml_files = []
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                if obj['Key'].lower().endswith('.eml'):
-                    eml_files.append(obj['Key'])
+        for entry in pages.search('Contents[].[Key, ETag, Size]'):
+            # Pages without Contents (empty bucket or prefix) yield None
+            if not entry:
+                continue
+            key, etag, size = entry
+            if exclude_prefix and key.startswith(exclude_prefix):
+                continue
+            if key.lower().endswith('.eml') or is_eml_bundle(key):
+                eml_files.append((key, etag, size))
         
         return eml_files
     except ClientError as e:
         st.error(f"Error listing files from S3: {str(e)}")
         return []
 
-def download_eml_from_s3(bucket_name, file_key):
-    """Download EML file content from S3"""
-    s3_client = get_s3_client()
-    if not s3_client:
-        return None
+def download_eml_from_s3(s3_client, bucket_name, file_key, transfer_manager=None):
+    """Download EML file content from S3, raising on failure"""
+    # Errors propagate - besides ClientError the CRT raises its own AwsCrtError,
+    # and this runs on a download thread where st.error would be dropped
+    if transfer_manager:
+        buffer = io.BytesIO()
+        transfer_manager.download(bucket_name, file_key, buffer).result()
+        return buffer.getvalue()
+    
+    response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+    return response['Body'].read()
+
+def fetch_eml_bundle(s3_client, bucket_name, bundle_key):
+    """Stream a tar bundle from S3 and yield (name, content) for each EML member"""
+    response = s3_client.get_object(Bucket=bucket_name, Key=bundle_key)
+    with tarfile.open(fileobj=response['Body'], mode='r|*') as bundle:
+        for member in bundle:
+            if member.isfile() and member.name.lower().endswith('.eml'):
+                yield member.name, bundle.extractfile(member).read()
+
+def download_single_email(s3_client, bucket_name, file_key, transfer_manager=None):
+    """Download a single email file as [(name, content)], or None if it is empty"""
+    file_content = download_eml_from_s3(s3_client, bucket_name, file_key, transfer_manager)
+    return [(file_key, file_content)] if file_content else None
+
+def download_email_bundle(s3_client, bucket_name, bundle_key):
+    """Download every email in a tar bundle as [(name, content)], raising on failure"""
+    # ClientError or TarError propagate, to be reported from the main thread
+    return list(fetch_eml_bundle(s3_client, bucket_name, bundle_key))
+
+# Sentinel telling the parse stage that no more downloads are coming
+PIPELINE_DONE = object()
+
+@st.cache_resource(show_spinner=False)
+def get_parse_executor():
+    """Shared process pool for the CPU-bound EML parsing"""
+    # spawn, as forking the multi-threaded Streamlit server is unsafe
+    return ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context('spawn')
+    )
+
+# Serializes replacing a broken parse pool across the parse threads
+PARSE_EXECUTOR_LOCK = threading.Lock()
+
+def submit_parse(file_content, filename):
+    """Submit an EML file to the parse pool, replacing the pool if it broke"""
+    executor = get_parse_executor()
+    try:
+        return executor.submit(parse_s3_eml, file_content, filename)
+    except BrokenProcessPool:
+        with PARSE_EXECUTOR_LOCK:
+            # Another parse thread may already have replaced it
+            if get_parse_executor() is executor:
+                get_parse_executor.clear()
+                executor.shutdown(wait=False)
+            executor = get_parse_executor()
+        return executor.submit(parse_s3_eml, file_content, filename)
+
+def attachment_exists(s3_client, bucket_name, s3_key):
+    """Check whether an attachment was already extracted to S3"""
+    from botocore.exceptions import ClientError
     
     try:
-        response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-        return response['Body'].read()
+        s3_client.head_object(Bucket=bucket_name, Key=s3_key)
+        return True
     except ClientError as e:
-        st.error(f"Error downloading {file_key} from S3: {str(e)}")
-        return None
+        return False
+
+class AttachmentUploadError(Exception):
+    """Raised when some attachments of an object could not be stored; carries the parsed emails"""
+    def __init__(self, emails, failed):
+        super().__init__(f"{failed} attachments could not be stored")
+        self.emails = emails
+
+def upload_attachments(s3_client, bucket_name, attachment_prefix, etag, emails):
+    """Store extracted attachments under the attachment prefix, keeping only their keys"""
+    from botocore.exceptions import ClientError
+    
+    # Keys are derived from the source object's ETag, so each part is uploaded once
+    object_id = etag.strip('"')
+    failed = 0
+    for i, email_data in enumerate(emails):
+        for j, attachment in enumerate(email_data['attachments']):
+            # The real name stays the last segment, as the table shows it as the link
+            # text; boto3 URL-quotes it in the presigned URL and the table decodes it
+            safe_name = re.sub(r'[/\\\x00-\x1f\x7f]', '_', attachment['filename'])
+            if safe_name in ('.', '..'):
+                # Browsers would resolve these path segments away
+                safe_name = '_'
+            s3_key = f"{attachment_prefix}{object_id}/{i}/{j}/{safe_name}"
+            try:
+                if not attachment_exists(s3_client, bucket_name, s3_key):
+                    s3_client.put_object(
+                        Bucket=bucket_name,
+                        Key=s3_key,
+                        Body=decode_attachment(attachment['payload_raw'], attachment['cte']),
+                        ContentType=attachment['content_type']
+                    )
+                attachment['s3_key'] = s3_key
+                # The browser fetches it from S3, so don't keep the bytes in the cache
+                del attachment['payload_raw']
+            except ClientError as e:
+                # Left without a key, shown as a missing link
+                failed += 1
+    
+    # Raising keeps a partial result out of the cache, so the upload is retried next run
+    if failed:
+        raise AttachmentUploadError(emails, failed)
 
-def parse_s3_eml(file_content, filename):
-    """Parse an EML file from S3 and extract its content."""
+@st.cache_data(show_spinner=False, max_entries=5000, ttl=86400)
+def parse_cached_emails(bucket_name, file_key, etag, attachment_prefix="", _s3_client=None, _downloads=None):
+    """Parse the downloaded emails of one S3 object, cached by (bucket, key, ETag)"""
+    # Called without downloads to probe the cache - raising keeps the miss uncached
+    if _downloads is None:
+        raise KeyError(file_key)
+    
+    # Parse on the process pool; this thread only waits for the results
+    parse_futures = [submit_parse(file_content, name) for name, file_content in _downloads]
+    emails = [
+        email_data for email_data in (future.result() for future in parse_futures)
+        if email_data is not None
+    ]
+    
+    if attachment_prefix:
+        upload_attachments(_s3_client, bucket_name, attachment_prefix, etag, emails)
+    return emails
+
+def fetch_stage(s3_client, bucket_name, file_key, etag, attachment_prefix, transfer_manager, download_queue):
+    """Pipeline GET stage: queue cached emails, or the downloaded bytes to parse"""
     try:
-        msg = BytesParser(policy=policy.default).parsebytes(file_content)
-        
-        # Extract basic information
-        subject = msg.get('Subject', 'No Subject')
-        sender = msg.get('From', 'Unknown Sender')
-        recipient = msg.get('To', 'Unknown Recipient')
-        date_raw = msg.get('Date', 'Unknown Date')
-        
-        # Parse and format the date
-        date_formatted, date_obj = parse_and_format_date(date_raw)
+        try:
+            download_queue.put((file_key, etag, parse_cached_emails(bucket_name, file_key, etag, attachment_prefix), None, None))
+            return
+        except KeyError:
+            pass
         
-        # Extract body content
-        body_text = ""
-        body_html = ""
-        attachments = []
-        
-        # Walk through all parts of the email
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disposition = str(part.get('Content-Disposition', ''))
-            
-            # Extract text and HTML body
-            if content_type == 'text/plain' and 'attachment' not in content_disposition:
-                body_text = part.get_content()
-            elif content_type == 'text/html' and 'attachment' not in content_disposition:
-                body_html = part.get_content()
-            
-            # Extract attachments
-            elif 'attachment' in content_disposition or part.get_filename():
-                attach_filename = part.get_filename()
-                if attach_filename:
-                    try:
-                        content = part.get_content()
-                        if isinstance(content, str):
-                            content = content.encode()
-                        attachments.append({
-                            'filename': attach_filename,
-                            'content': content,
-                            'content_type': content_type
-                        })
-                    except Exception as e:
-                        # Use a placeholder for failed attachments instead of showing error
-                        pass
+        # Bundles are fetched with one GET per archive, loose EML files per object
+        if is_eml_bundle(file_key):
+            downloads = download_email_bundle(s3_client, bucket_name, file_key)
+        else:
+            downloads = download_single_email(s3_client, bucket_name, file_key, transfer_manager)
         
-        return {
-            'subject': subject,
-            'sender': sender,
-            'recipient': recipient,
-            'date': date_formatted,
-            'date_obj': date_obj,  # Keep datetime object for sorting
-            'body_text': body_text,
-            'body_html': body_html,
-            'attachments': attachments
-        }
-    
+        # Failed downloads are passed on as empty, uncached, and retried next rerun
+        download_queue.put((file_key, etag, [] if downloads is None else None, downloads, None))
     except Exception as e:
-        return None
+        # st.error is dropped on this thread, so the message goes to the main thread
+        action = "reading bundle" if is_eml_bundle(file_key) else "downloading"
+        download_queue.put((file_key, etag, [], None, f"Error {action} {file_key} from S3: {str(e)}"))
 
-def process_single_email(bucket_name, file_key):
-    """Process a single email file - for parallel processing"""
-    try:
-        file_content = download_eml_from_s3(bucket_name, file_key)
-        if file_content:
-            return parse_s3_eml(file_content, file_key)
-        return None
-    except Exception as e:
-        return None
+def submit_fetches(fetch_executor, in_flight, fetch_args):
+    """Submit fetch tasks as slots free up, instead of queueing them all at once"""
+    for args in fetch_args:
+        in_flight.acquire()
+        try:
+            future = fetch_executor.submit(fetch_stage, *args)
+        except RuntimeError:
+            # Executor shut down early, e.g. by an interrupted rerun
+            return
+        future.add_done_callback(lambda _: in_flight.release())
+
+def parse_stage(s3_client, bucket_name, attachment_prefix, download_queue, results_queue):
+    """Pipeline parse stage: parse queued downloads until the end sentinel"""
+    while True:
+        item = download_queue.get()
+        if item is PIPELINE_DONE:
+            return
+        
+        file_key, etag, emails, downloads, error = item
+        if emails is None:
+            try:
+                emails = parse_cached_emails(
+                    bucket_name, file_key, etag, attachment_prefix, s3_client, downloads
+                )
+            except AttachmentUploadError as e:
+                # Show what was parsed this run, without caching it
+                emails = e.emails
+            except Exception as e:
+                emails = []
+        results_queue.put((etag, emails, error))
 
-def process_emails_parallel(bucket_name, eml_files, max_workers=5):
-    """Process emails in parallel using ThreadPoolExecutor"""
+def process_emails_parallel(s3_client, bucket_name, eml_files, max_workers=5, transfer_manager=None, attachment_prefix=""):
+    """Process emails with overlapping download and parse stages, skipping cached ETags"""
     all_emails_data = []
     max_attachments = 0
+    download_errors = []
+    
+    # Identical objects share an ETag - fetch and parse one, reuse it for the rest
+    keys_by_etag = {}
+    for file_key, etag, _ in eml_files:
+        keys_by_etag.setdefault(etag, []).append(file_key)
+    
+    # Bounded so downloads can't run far ahead of parsing and pile up in memory
+    download_queue = queue.Queue(maxsize=2 * max_workers)
+    results_queue = queue.Queue()
+    parse_workers = os.cpu_count() or 1
     
     # Create progress tracking
     progress_bar = st.progress(0)
     status_text = st.empty()
     
-    # Use ThreadPoolExecutor for parallel processing
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all tasks
-        future_to_file = {
-            executor.submit(process_single_email, bucket_name, file_key): file_key 
-            for file_key in eml_files
-        }
+    # ThreadPoolExecutors for the I/O-bound downloads and for feeding the parse pool
+    fetch_executor = ThreadPoolExecutor(max_workers=max_workers)
+    parse_executor = ThreadPoolExecutor(max_workers=parse_workers)
+    try:
+        for _ in range(parse_workers):
+            parse_executor.submit(
+                parse_stage, s3_client, bucket_name, attachment_prefix, download_queue, results_queue
+            )
+        # Two slots per worker, so a freed worker never waits on the feeder
+        in_flight = threading.BoundedSemaphore(2 * max_workers)
+        fetch_args = (
+            (s3_client, bucket_name, file_keys[0], etag, attachment_prefix, transfer_manager, download_queue)
+            for etag, file_keys in keys_by_etag.items()
+        )
+        threading.Thread(
+            target=submit_fetches, args=(fetch_executor, in_flight, fetch_args), daemon=True
+        ).start()
         
-        completed = 0
-        total = len(eml_files)
+        total = len(keys_by_etag)
         
-        # Process completed tasks
-        for future in concurrent.futures.as_completed(future_to_file):
-            file_key = future_to_file[future]
-            completed += 1
+        # Every unique file yields exactly one result, so progress tracks parse completion
+        for completed in range(1, total + 1):
+            etag, emails, error = results_queue.get()
+            if error:
+                download_errors.append(error)
             
             # Update progress
             progress_bar.progress(completed / total)
-            status_text.text(f"Processed {completed}/{total} files...")
+            status_text.text(f"Processed {completed}/{total} unique files...")
             
-            try:
-                email_data = future.result()
-                if email_data is not None:
-                    all_emails_data.append(email_data)
-                    # Track maximum number of attachments for table columns
-                    if len(email_data['attachments']) > max_attachments:
-                        max_attachments = len(email_data['attachments'])
-            except Exception as e:
-                # Silently skip failed emails
-                pass
+            # Duplicates share the parsed (read-only) email dicts
+            for email_data in emails * len(keys_by_etag[etag]):
+                all_emails_data.append(email_data)
+                # Track maximum number of attachments for table columns
+                if len(email_data['attachments']) > max_attachments:
+                    max_attachments = len(email_data['attachments'])
+    finally:
+        # Let in-flight downloads drain into the parse stage before stopping it,
+        # also when a rerun interrupts the script mid-way
+        fetch_executor.shutdown(cancel_futures=True)
+        for _ in range(parse_workers):
+            download_queue.put(PIPELINE_DONE)
+        parse_executor.shutdown()
     
     progress_bar.empty()
     status_text.empty()
     
-    return all_emails_data, max_attachments
+    return all_emails_data, max_attachments, download_errors
+
+TABLE_STYLE = """<style>
+#eml-table { width: 100%; border-collapse: collapse; table-layout: fixed; }
+#eml-table thead tr { background-color: #f0f2f6; }
+#eml-table th, #eml-table td { padding: 8px; border: 1px solid #ddd; white-space: nowrap; overflow: hidden; text-overflow: ellipsis; }
+#eml-table th { text-align: left; }
+</style>"""
+
+# Script and style tags, plus potentially dangerous on* attributes
+UNSAFE_HTML_RE = re.compile(
+    r'<script[^>]*>.*?</script>'
+    r'|<style[^>]*>.*?</style>'
+    r'|on\w+="[^"]*"'
+    r"|on\w+='[^']*'",
+    flags=re.DOTALL | re.IGNORECASE
+)
+
+def render_table_html(df):
+    """Render the email table as HTML; cells must already be escaped or link markup."""
+    header = ''.join(f"<th>{col}</th>" for col in df.columns)
+    # Plain nested lists avoid pandas' per-row boxing when iterating
+    rows = ''.join(
+        '<tr>' + ''.join(f"<td>{cell}</td>" for cell in row) + '</tr>'
+        for row in df.to_numpy(dtype=object).tolist()
+    )
+    return f"{TABLE_STYLE}<table id='eml-table'><thead><tr>{header}</tr></thead><tbody>{rows}</tbody></table>"
+
+def format_text_column(column):
+    """Escape a text column like html.escape, keeping the full value as a hover tooltip."""
+    # Vectorized string ops, '&' first so the other entities aren't double-escaped
+    escaped = (
+        column.astype(str)
+        .str.replace('&', '&amp;', regex=False)
+        .str.replace('<', '&lt;', regex=False)
+        .str.replace('>', '&gt;', regex=False)
+        .str.replace('"', '&quot;', regex=False)
+        .str.replace("'", '&#x27;', regex=False)
+    )
+    return "<span title='" + escaped + "'>" + escaped + "</span>"
 
 def clean_html(html_content):
     """Clean HTML content for safe display."""
     if not html_content:
         return ""
     
-    # Remove script and style tags
-    html_content = re.sub(r'<script[^>]*>.*?</script>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-    html_content = re.sub(r'<style[^>]*>.*?</style>', '', html_content, flags=re.DOTALL | re.IGNORECASE)
-    
-    # Remove potentially dangerous attributes
-    html_content = re.sub(r'on\w+="[^"]*"', '', html_content, flags=re.IGNORECASE)
-    html_content = re.sub(r"on\w+='[^']*'", '', html_content, flags=re.IGNORECASE)
-    
-    return html_content
+    # Remove script/style tags and event handler attributes in a single pass
+    return UNSAFE_HTML_RE.sub('', html_content)
+
+# Larger attachments get a download button instead of an inline data: URI
+INLINE_ATTACHMENT_LIMIT = 64 * 1024
+
+def attachment_size(payload_raw, cte):
+    """Approximate decoded size of an attachment payload in bytes."""
+    if cte == 'base64' and isinstance(payload_raw, str):
+        return len(payload_raw) * 3 // 4
+    return len(payload_raw)
 
-def create_download_link(content, filename, content_type):
+def decode_attachment(payload_raw, cte):
+    """Decode an attachment payload to bytes, only when it is downloaded."""
+    if cte == 'base64' and isinstance(payload_raw, str):
+        return base64.b64decode(payload_raw)
+    if isinstance(payload_raw, str):
+        return payload_raw.encode()
+    return payload_raw
+
+def create_button_placeholder(filename):
+    """Create a table cell pointing to the download button below the table."""
+    filename = html.escape(filename)
+    return f'''<span title="Download {filename} below the table" style="display: inline-block; padding: 4px 8px; margin: 2px; background-color: #6c757d; color: white; border-radius: 4px; font-size: 12px; white-space: nowrap;">⬇ {filename}</span>'''
+
+def create_download_link(payload_raw, cte, filename, content_type):
     """Create a download link for attachments."""
-    if isinstance(content, str):
-        content = content.encode()
+    if cte == 'base64' and isinstance(payload_raw, str):
+        # Already base64 on the wire, only strip the MIME line breaks
+        b64_content = ''.join(payload_raw.split())
+    else:
+        if isinstance(payload_raw, str):
+            payload_raw = payload_raw.encode()
+        b64_content = base64.b64encode(payload_raw).decode()
+    
+    filename = html.escape(filename)
+    return f'''<a href="data:{content_type};base64,{b64_content}" download="{filename}" style="display: inline-block; padding: 4px 8px; margin: 2px; background-color: #0066cc; color: white; text-decoration: none; border-radius: 4px; font-size: 12px; white-space: nowrap;">📎 {filename}</a>'''
+
+# Lifetime of the attachment links handed to the browser
+PRESIGNED_URL_EXPIRY = 3600
+
+def presigned_attachment_url(s3_client, bucket_name, email_data, j):
+    """Create a presigned URL for the j-th extracted attachment, or None."""
+    if j >= len(email_data['attachments']):
+        return None
     
-    b64_content = base64.b64encode(content).decode()
+    attachment = email_data['attachments'][j]
+    if 's3_key' not in attachment:
+        return None
     
-    return f'''<a href="data:{content_type};base64,{b64_content}" download="{filename}" style="display: inline-block; padding: 4px 8px; margin: 2px; background-color: #0066cc; color: white; text-decoration: none; border-radius: 4px; font-size: 12px; white-space: nowrap;">📎 {filename}</a>'''
+    return s3_client.generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': bucket_name,
+            'Key': attachment['s3_key'],
+            'ResponseContentDisposition': f"attachment; filename*=UTF-8''{quote(attachment['filename'])}"
+        },
+        ExpiresIn=PRESIGNED_URL_EXPIRY
+    )
+
+def create_attachment_cell(i, j, email_data, large_attachments):
+    """Create the table cell for the j-th attachment of the i-th email."""
+    if j >= len(email_data['attachments']):
+        return ''
+    
+    attachment = email_data['attachments'][j]
+    if attachment_size(attachment['payload_raw'], attachment['cte']) <= INLINE_ATTACHMENT_LIMIT:
+        return create_download_link(
+            attachment['payload_raw'],
+            attachment['cte'],
+            attachment['filename'],
+            attachment['content_type']
+        )
+    
+    # Too large to inline on every rerun - served on click instead
+    large_attachments.append((i, j, email_data['subject'], attachment))
+    return create_button_placeholder(attachment['filename'])
 
 def main():
     st.set_page_config(
@@ -312,17 +574,22 @@ def main():
     
     st.markdown("---")
     
+    # Enough concurrency to approach S3's per-prefix request rate, within reason
+    default_workers = min(64, max(8, 4 * (os.cpu_count() or 4)))
+    
     # S3 Configuration
     try:
         # Try Streamlit secrets first (cloud), then environment variables (local)
         if hasattr(st, 'secrets') and 'S3_BUCKET_NAME' in st.secrets:
             bucket_name = st.secrets["S3_BUCKET_NAME"]
             folder_prefix = st.secrets.get("S3_FOLDER_PREFIX", "")
-            max_workers = st.secrets.get("MAX_WORKERS", 5)
+            max_workers = st.secrets.get("MAX_WORKERS", default_workers)
+            attachment_prefix = st.secrets.get("S3_ATTACHMENT_PREFIX", "")
         else:
             bucket_name = os.getenv("S3_BUCKET_NAME")
             folder_prefix = os.getenv("S3_FOLDER_PREFIX", "")
-            max_workers = int(os.getenv("MAX_WORKERS", 5))
+            max_workers = int(os.getenv("MAX_WORKERS", default_workers))
+            attachment_prefix = os.getenv("S3_ATTACHMENT_PREFIX", "")
             
         if not bucket_name:
             raise ValueError("S3_BUCKET_NAME not found")
@@ -335,31 +602,51 @@ def main():
         """)
         return
     
+    max_workers = st.slider(
+        "⚙️ Parallel download workers",
+        min_value=1,
+        max_value=64,
+        value=max(1, min(64, int(max_workers)))
+    )
+    
+    s3_client = get_s3_client(max_workers)
+    if not s3_client:
+        return
+    
     # Get EML files from S3
     with st.spinner("Loading EML files from S3..."):
-        eml_files = list_eml_files_from_s3(bucket_name, folder_prefix)
+        eml_files = list_eml_files_from_s3(s3_client, bucket_name, folder_prefix, attachment_prefix)
     
     if not eml_files:
         st.warning("No EML files found in S3 bucket.")
         st.info(f"Please upload EML files to s3://{bucket_name}/{folder_prefix}")
         return
     
-    st.success(f"Found {len(eml_files)} EML files in S3")
+    bundle_count = sum(1 for file_key, _, _ in eml_files if is_eml_bundle(file_key))
+    if bundle_count:
+        st.success(f"Found {len(eml_files) - bundle_count} EML files and {bundle_count} EML bundles in S3")
+    else:
+        st.success(f"Found {len(eml_files)} EML files in S3")
     
     # Add processing info
-    st.info(f"🚀 Using parallel processing with {max_workers} workers")
+    st.info(f"🚀 Using parallel processing with {max_workers} download workers and {os.cpu_count()} parse processes")
     
     # Process emails in parallel
     with st.spinner("Processing emails in parallel..."):
-        all_emails_data, max_attachments = process_emails_parallel(bucket_name, eml_files, max_workers)
+        all_emails_data, max_attachments, download_errors = process_emails_parallel(
+            s3_client, bucket_name, eml_files, max_workers,
+            get_transfer_manager(s3_client, max_workers),
+            attachment_prefix
+        )
+    
+    # Reported here, as the download threads can't write to the page
+    for error in download_errors:
+        st.error(error)
     
     if not all_emails_data:
         st.error("Could not parse any EML files.")
         return
     
-    # Sort emails by date (latest first) - handle None dates
-    all_emails_data.sort(key=lambda x: x['date_obj'] if x['date_obj'] else datetime.min, reverse=True)
-    
     # Display summary statistics
     col1, col2, col3 = st.columns(3)
     with col1:
@@ -370,63 +657,83 @@ def main():
     with col3:
         st.metric("📁 Max Attachments per Email", max_attachments)
     
-    # Create table data
-    table_data = []
-    
-    for i, email_data in enumerate(all_emails_data):
-        row = {
-            'From': email_data['sender'],
-            'Date': email_data['date'],
-            'Title': email_data['subject']
-        }
-        
-        # Add attachment columns with download links
-        for j in range(max_attachments):
-            if j < len(email_data['attachments']):
-                attachment = email_data['attachments'][j]
-                download_link = create_download_link(
-                    attachment['content'],
-                    attachment['filename'],
-                    attachment['content_type']
-                )
-                row[f'Attachment_{j+1}'] = download_link
-            else:
-                row[f'Attachment_{j+1}'] = ''
-        
-        table_data.append(row)
+    # Imported here so the login screen doesn't pay for pandas at cold start
+    import pandas as pd
     
-    # Create DataFrame
-    df = pd.DataFrame(table_data)
+    # Build the table column-wise and sort by date (latest first, missing dates last)
+    df = pd.DataFrame({
+        'From': [email_data['sender'] for email_data in all_emails_data],
+        'Date': [email_data['date'] for email_data in all_emails_data],
+        'Title': [email_data['subject'] for email_data in all_emails_data],
+        '_dt': [email_data['date_obj'] for email_data in all_emails_data]
+    }).sort_values('_dt', ascending=False, na_position='last', kind='mergesort')
+    sorted_emails = [all_emails_data[k] for k in df.index]
+    df = df.drop(columns='_dt').reset_index(drop=True)
     
-    # Display the table with HTML rendering for download links
     st.markdown("### Email Overview")
     
-    # Create custom HTML table for better control
-    table_html = "<table style='width:100%; border-collapse: collapse; table-layout: fixed;'>"
-    
-    # Header
-    table_html += "<thead><tr style='background-color: #f0f2f6; border: 1px solid #ddd;'>"
-    for col in df.columns:
-        table_html += f"<th style='padding: 8px; text-align: left; border: 1px solid #ddd; white-space: nowrap; overflow: hidden; text-overflow: ellipsis;'>{col}</th>"
-    table_html += "</tr></thead>"
-    
-    # Body
-    table_html += "<tbody>"
-    for _, row in df.iterrows():
-        table_html += "<tr style='border: 1px solid #ddd;'>"
-        for col in df.columns:
-            cell_value = row[col] if pd.notna(row[col]) else ""
-            if col.startswith('Attachment_') and cell_value:
-                # This is an attachment cell with HTML link
-                table_html += f"<td style='padding: 8px; border: 1px solid #ddd; white-space: nowrap; overflow: hidden;'>{cell_value}</td>"
-            else:
-                # Regular text cell
-                table_html += f"<td style='padding: 8px; border: 1px solid #ddd; white-space: nowrap; overflow: hidden; text-overflow: ellipsis;' title='{html.escape(str(cell_value))}'>{html.escape(str(cell_value))}</td>"
-        table_html += "</tr>"
-    table_html += "</tbody></table>"
-    
-    # Display the HTML table
-    st.markdown(table_html, unsafe_allow_html=True)
+    if attachment_prefix:
+        # Attachments were extracted to S3, so link to them and let st.dataframe
+        # render only the visible rows
+        df = df.assign(**{
+            f'Attachment_{j+1}': [
+                presigned_attachment_url(s3_client, bucket_name, email_data, j)
+                for email_data in sorted_emails
+            ]
+            for j in range(max_attachments)
+        })
+        st.dataframe(
+            df,
+            hide_index=True,
+            column_config={
+                f'Attachment_{j+1}': st.column_config.LinkColumn(display_text=r"/([^/?]+)\?")
+                for j in range(max_attachments)
+            }
+        )
+        
+        # ETag duplicates share the same parsed dicts, so count each object once
+        unique_emails = {id(email_data): email_data for email_data in all_emails_data}.values()
+        missing = sum(
+            1 for email_data in unique_emails
+            for attachment in email_data['attachments'] if 's3_key' not in attachment
+        )
+        if missing:
+            st.warning(f"{missing} attachments could not be stored under s3://{bucket_name}/{attachment_prefix}")
+    else:
+        # Add attachment columns with download links
+        large_attachments = []
+        df = df.assign(**{
+            f'Attachment_{j+1}': [
+                create_attachment_cell(i, j, email_data, large_attachments)
+                for i, email_data in enumerate(sorted_emails)
+            ]
+            for j in range(max_attachments)
+        })
+        
+        # Escape the text columns once; attachment columns already hold link HTML
+        text_cols = ['From', 'Date', 'Title']
+        df[text_cols] = df[text_cols].apply(format_text_column)
+        
+        # Build the table in a single join, styled via a scoped stylesheet
+        table_html = render_table_html(df)
+        
+        # Display the HTML table
+        st.markdown(table_html, unsafe_allow_html=True)
+        
+        # Large attachments are only decoded and sent when their button is clicked
+        if large_attachments:
+            st.markdown("### Large Attachments")
+            st.caption("These attachments are too large to embed in the table - download them here.")
+            for i, j, subject, attachment in large_attachments:
+                st.download_button(
+                    label=f"📎 {attachment['filename']}",
+                    data=functools.partial(decode_attachment, attachment['payload_raw'], attachment['cte']),
+                    file_name=attachment['filename'],
+                    mime=attachment['content_type'],
+                    key=f"dl_{i}_{j}",
+                    help=subject,
+                    on_click='ignore'
+                )
     
     st.markdown("---")
     st.markdown("**Note:** Click on the attachment links in the table to download files directly.")